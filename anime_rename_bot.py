@@ -1,38 +1,57 @@
 import os
 import re
+import sys
+import html
+import functools
 import asyncio
+import signal
+import secrets
+from pathlib import Path
 from telegram import Update
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
-from telegram.constants import ChatAction
+from telegram.constants import ChatAction, ParseMode
+from aiohttp import web
 import logging
-from threading import Thread
-from http.server import HTTPServer, BaseHTTPRequestHandler
 
 # Enable logging
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+# Don't print tracebacks for errors raised while emitting log records
+logging.raiseExceptions = False
 logger = logging.getLogger(__name__)
 
-class AnimeRenameBot:
-    def __init__(self, token):
-        self.token = token
-        self.app = Application.builder().token(token).build()
-        self.setup_handlers()
-    
-    def setup_handlers(self):
-        """Setup bot command and message handlers"""
-        self.app.add_handler(CommandHandler("start", self.start))
-        self.app.add_handler(CommandHandler("help", self.help_command))
-        self.app.add_handler(MessageHandler(filters.Document.ALL, self.handle_document))
-        self.app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_text))
-    
-    async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Send a message when the command /start is issued"""
-        welcome_text = """
-🎌 **Anime Auto Rename Bot** 🎌
+# Common anime filename patterns, compiled once at import and tried in order
+_ANIME_PATTERNS = tuple(re.compile(p, re.IGNORECASE) for p in (
+    # [SubGroup] Anime Name - 01 [Quality]
+    r'\[.*?\]\s*(.+?)\s*-\s*(\d+)',
+    # Anime.Name.S01E01 or Anime.Name.Episode.01
+    r'(.+?)\.(?:S\d+E(\d+)|Episode\.(\d+))',
+    # Anime Name Episode 01
+    r'(.+?)\s+Episode\s+(\d+)',
+    # Anime Name - 01
+    r'(.+?)\s*-\s*(\d+)',
+    # Anime Name 01
+    r'(.+?)\s+(\d+)(?:\s|$)',
+))
+# Names without a '[' can never match the [SubGroup] pattern, so they skip it
+_ANIME_PATTERNS_NO_GROUP = _ANIME_PATTERNS[1:]
+# Quality tags are dropped and separator runs become spaces in one pass. The
+# lookarounds treat '_' as a separator, matching word boundaries as they were
+# when separators were replaced before the tags were stripped.
+_CLEANUP = re.compile(
+    r'(?<![^\W_])(720p|1080p|480p|BD|BluRay|WEB|HDTV)(?![^\W_])|[\.\-_]+',
+    re.IGNORECASE,
+)
+_CLEAN_WS = re.compile(r'\s+')
+_INVALID_FN_TABLE = str.maketrans('', '', '<>:"/\\|?*')
+_VIDEO_EXTENSIONS = ('.mkv', '.mp4', '.avi', '.mov', '.wmv', '.flv', '.webm')
+
+# Static replies, pre-rendered as HTML
+_WELCOME_HTML = """
+🎌 <b>Anime Auto Rename Bot</b> 🎌
 
 Welcome! I can help you automatically rename anime files with proper formatting.
 
-**Features:**
+<b>Features:</b>
 • Auto-detect anime names from filenames
 • Standardize episode numbering
 • Clean up messy filenames
@@ -41,96 +60,122 @@ Welcome! I can help you automatically rename anime files with proper formatting.
 Send me an anime file and I'll rename it for you!
 
 Use /help for more information.
-        """
-        await update.message.reply_text(welcome_text, parse_mode='Markdown')
-    
-    async def help_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Send help information"""
-        help_text = """
-🔧 **How to use:**
+"""
+
+_HELP_HTML = """
+🔧 <b>How to use:</b>
 
 1. Send me an anime video file
 2. I'll automatically detect the anime name and episode
 3. You'll receive the renamed file
 
-**Supported formats:**
+<b>Supported formats:</b>
 • .mkv, .mp4, .avi, .mov, .wmv
 
-**Naming patterns I can detect:**
-• `[SubGroup] Anime Name - 01 [Quality].mkv`
-• `Anime.Name.S01E01.mkv`
-• `Anime Name Episode 01.mp4`
+<b>Naming patterns I can detect:</b>
+• <code>[SubGroup] Anime Name - 01 [Quality].mkv</code>
+• <code>Anime.Name.S01E01.mkv</code>
+• <code>Anime Name Episode 01.mp4</code>
 • And many more!
 
-**Commands:**
+<b>Commands:</b>
 /start - Start the bot
 /help - Show this help message
 
-**Note:** Large files may take some time to process.
-        """
-        await update.message.reply_text(help_text, parse_mode='Markdown')
+<b>Note:</b> Large files may take some time to process.
+"""
+
+# Reply to "test: filename" messages; fields must be HTML-escaped
+_TEST_RESPONSE = (
+    "<b>Original:</b> <code>{0}</code>\n"
+    "<b>Detected Anime:</b> {1}\n"
+    "<b>Episode:</b> {2}\n"
+    "<b>New Filename:</b> <code>{3}</code>"
+)
+
+def _cleanup_repl(match):
+    """Drop quality tags, turn separator runs into a space"""
+    return '' if match.group(1) else ' '
+
+# Parsing is a pure function of the filename, so repeated names (resent
+# files, whole-season uploads, test: messages) are served from a cache
+@functools.lru_cache(maxsize=1024)
+def _extract_anime_info(name):
+    """Extract anime name and episode from a filename without its extension"""
+    patterns = _ANIME_PATTERNS if '[' in name else _ANIME_PATTERNS_NO_GROUP
+    for pattern in patterns:
+        match = pattern.search(name)
+        if match:
+            anime_name = match.group(1).strip()
+            episode = match.group(2) or match.group(3)
+            
+            # Clean up anime name and remove common quality indicators
+            anime_name = _CLEANUP.sub(_cleanup_repl, anime_name)
+            anime_name = _CLEAN_WS.sub(' ', anime_name).strip()
+            
+            # Episodes of one season share a single title string
+            return sys.intern(anime_name), episode
+
+    # If no pattern matches, return original name
+    return name, None
+
+@functools.lru_cache(maxsize=1024)
+def _generate_new_filename(anime_name, episode, extension):
+    """Generate a clean filename"""
+    if episode:
+        # Pad episode number with zeros
+        episode_num = str(episode).zfill(2)
+        new_filename = f"{anime_name} - Episode {episode_num}{extension}"
+    else:
+        new_filename = f"{anime_name}{extension}"
+
+    # Remove invalid characters for filename
+    new_filename = new_filename.translate(_INVALID_FN_TABLE)
+
+    return new_filename
+
+class AnimeRenameBot:
+    def __init__(self, token):
+        self.token = token
+        # Handle updates from different users concurrently; file transfers
+        # are bounded separately by the I/O semaphore created in serve()
+        self.app = Application.builder().token(token).concurrent_updates(True).build()
+        self._io_limit = int(os.getenv('IO_CONCURRENCY', '4'))
+        self._io_sem = None
+        self._webhook_secret = None
+        self.setup_handlers()
     
-    def extract_anime_info(self, filename):
-        """Extract anime name and episode from filename"""
-        # Remove file extension
-        name = os.path.splitext(filename)[0]
-        
-        # Common anime filename patterns
-        patterns = [
-            # [SubGroup] Anime Name - 01 [Quality]
-            r'\[.*?\]\s*(.+?)\s*-\s*(\d+)',
-            # Anime.Name.S01E01 or Anime.Name.Episode.01
-            r'(.+?)\.(?:S\d+E(\d+)|Episode\.(\d+))',
-            # Anime Name Episode 01
-            r'(.+?)\s+Episode\s+(\d+)',
-            # Anime Name - 01
-            r'(.+?)\s*-\s*(\d+)',
-            # Anime Name 01
-            r'(.+?)\s+(\d+)(?:\s|$)',
-        ]
-        
-        for pattern in patterns:
-            match = re.search(pattern, name, re.IGNORECASE)
-            if match:
-                anime_name = match.group(1).strip()
-                episode = match.group(2) or match.group(3)
-                
-                # Clean up anime name
-                anime_name = re.sub(r'[\.\-_]+', ' ', anime_name)
-                anime_name = re.sub(r'\s+', ' ', anime_name).strip()
-                
-                # Remove common quality indicators
-                anime_name = re.sub(r'\b(720p|1080p|480p|BD|BluRay|WEB|HDTV)\b', '', anime_name, flags=re.IGNORECASE)
-                anime_name = anime_name.strip()
-                
-                return anime_name, episode
-        
-        # If no pattern matches, return original name
-        return name, None
+    def setup_handlers(self):
+        """Setup bot command and message handlers"""
+        self.app.add_handler(CommandHandler("start", self.start))
+        self.app.add_handler(CommandHandler("help", self.help_command))
+        self.app.add_handler(MessageHandler(filters.Document.ALL, self.handle_document))
+        self.app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_text))
+    
+    async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Send a message when the command /start is issued"""
+        await update.message.reply_text(_WELCOME_HTML, parse_mode=ParseMode.HTML)
     
-    def generate_new_filename(self, anime_name, episode, original_filename):
+    async def help_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Send help information"""
+        await update.message.reply_text(_HELP_HTML, parse_mode=ParseMode.HTML)
+    
+    def extract_anime_info(self, stem):
+        """Extract anime name and episode from a filename without its extension"""
+        return _extract_anime_info(stem)
+    
+    def generate_new_filename(self, anime_name, episode, ext):
         """Generate a clean filename"""
-        extension = os.path.splitext(original_filename)[1]
-        
-        if episode:
-            # Pad episode number with zeros
-            episode_num = str(episode).zfill(2)
-            new_filename = f"{anime_name} - Episode {episode_num}{extension}"
-        else:
-            new_filename = f"{anime_name}{extension}"
-        
-        # Remove invalid characters for filename
-        new_filename = re.sub(r'[<>:"/\\|?*]', '', new_filename)
-        
-        return new_filename
+        return _generate_new_filename(anime_name, episode, ext)
     
     async def handle_document(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle document/file uploads"""
         document = update.message.document
+        file_name = document.file_name
+        file_name_lower = file_name.lower()
         
         # Check if it's a video file
-        video_extensions = ['.mkv', '.mp4', '.avi', '.mov', '.wmv', '.flv', '.webm']
-        if not any(document.file_name.lower().endswith(ext) for ext in video_extensions):
+        if not file_name_lower.endswith(_VIDEO_EXTENSIONS):
             await update.message.reply_text("Please send a video file (.mkv, .mp4, .avi, etc.)")
             return
         
@@ -141,42 +186,56 @@ Use /help for more information.
         
         await update.message.reply_chat_action(ChatAction.TYPING)
         
+        # Download to temp location (prefixed so concurrent uploads of the
+        # same filename don't clash)
+        temp_path = f"temp/{update.update_id}_{file_name}"
+        
         try:
             # Extract anime info from filename
-            anime_name, episode = self.extract_anime_info(document.file_name)
-            new_filename = self.generate_new_filename(anime_name, episode, document.file_name)
-            
-            # Download the file
-            await update.message.reply_text("📥 Downloading file...")
-            file = await document.get_file()
-            
-            # Create temp directory if it doesn't exist
-            os.makedirs("temp", exist_ok=True)
+            stem, ext = os.path.splitext(file_name)
+            anime_name, episode = self.extract_anime_info(stem)
+            new_filename = self.generate_new_filename(anime_name, episode, ext)
+            caption = f"🎌 Renamed: {anime_name}" + (f" - Episode {episode}" if episode else "")
             
-            # Download to temp location
-            temp_path = f"temp/{document.file_name}"
-            await file.download_to_drive(temp_path)
+            # Telegram ignores `filename` when a file is re-sent by file_id, so
+            # the download can only be skipped when the name is already clean
+            if new_filename == file_name:
+                await update.message.reply_document(document=document.file_id, caption=caption)
+                return
             
-            # Rename file
-            new_path = f"temp/{new_filename}"
-            os.rename(temp_path, new_path)
-            
-            # Send renamed file back
-            await update.message.reply_text(f"✅ Renamed to: `{new_filename}`", parse_mode='Markdown')
-            
-            with open(new_path, 'rb') as f:
+            async with self._io_sem:
+                # Download the file
+                await update.message.reply_text("📥 Downloading file...")
+                file = await document.get_file()
+                
+                # Create temp directory if it doesn't exist
+                await asyncio.to_thread(os.makedirs, "temp", exist_ok=True)
+                
+                await file.download_to_drive(temp_path)
+                
+                await update.message.reply_text(f"✅ Renamed to: <code>{html.escape(new_filename)}</code>", parse_mode=ParseMode.HTML)
+                
+                # Send the file back under its new name; the rename only needs to
+                # happen in the upload, not on disk. PTB reads a path argument
+                # whole on the event loop, so read the file in a worker thread
+                # and hand over the bytes instead
+                data = await asyncio.to_thread(Path(temp_path).read_bytes)
                 await update.message.reply_document(
-                    document=f,
+                    document=data,
                     filename=new_filename,
-                    caption=f"🎌 Renamed: {anime_name}" + (f" - Episode {episode}" if episode else "")
+                    caption=caption
                 )
             
-            # Clean up temp files
-            os.remove(new_path)
-            
         except Exception as e:
-            logger.error(f"Error processing file: {e}")
+            logger.error("Error processing file: %s", e)
             await update.message.reply_text("❌ Sorry, there was an error processing your file.")
+        
+        finally:
+            # Clean up temp files
+            try:
+                await asyncio.to_thread(os.remove, temp_path)
+            except FileNotFoundError:
+                pass
     
     async def handle_text(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle text messages"""
@@ -185,52 +244,115 @@ Use /help for more information.
         # Test filename parsing
         if text.startswith("test:"):
             filename = text[5:].strip()
-            anime_name, episode = self.extract_anime_info(filename)
-            new_filename = self.generate_new_filename(anime_name, episode, filename)
+            stem, ext = os.path.splitext(filename)
+            anime_name, episode = self.extract_anime_info(stem)
+            new_filename = self.generate_new_filename(anime_name, episode, ext)
             
-            response = f"""
-**Original:** `{filename}`
-**Detected Anime:** {anime_name}
-**Episode:** {episode if episode else 'Not detected'}
-**New Filename:** `{new_filename}`
-            """
-            await update.message.reply_text(response, parse_mode='Markdown')
+            response = _TEST_RESPONSE.format(
+                html.escape(filename),
+                html.escape(anime_name),
+                html.escape(episode or 'Not detected'),
+                html.escape(new_filename)
+            )
+            await update.message.reply_text(response, parse_mode=ParseMode.HTML)
         else:
             await update.message.reply_text("Send me an anime file to rename, or use 'test: filename' to test parsing.")
     
+    async def handle_webhook(self, request):
+        """Queue an update posted by Telegram to the webhook"""
+        secret = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        # Compare as bytes: compare_digest rejects non-ASCII str with TypeError
+        if not secrets.compare_digest(secret.encode(), self._webhook_secret.encode()):
+            return web.Response(status=403)
+        
+        try:
+            data = await request.json()
+            update = Update.de_json(data, self.app.bot)
+        except Exception as e:
+            logger.warning("Invalid webhook update: %s", e)
+            return web.Response(status=400)
+        if update is None:
+            return web.Response(status=400)
+        
+        await self.app.update_queue.put(update)
+        return web.Response()
+    
+    async def handle_health(self, request):
+        """Answer health checks from the hosting platform"""
+        return web.Response(text='Bot is running!')
+    
+    async def serve(self, port, webhook_host):
+        """Receive updates and serve health checks on one event loop"""
+        # Created on the running loop; on Python 3.9 a Semaphore binds to the
+        # loop that is current when it is constructed
+        self._io_sem = asyncio.Semaphore(self._io_limit)
+        
+        web_app = web.Application()
+        web_app.router.add_get("/", self.handle_health)
+        if webhook_host:
+            # Only Telegram knows this, so stray POSTs to the route are refused
+            self._webhook_secret = secrets.token_urlsafe(32)
+            web_app.router.add_post(f"/{self.token}", self.handle_webhook)
+        runner = web.AppRunner(web_app, access_log=None) if port else None
+        
+        async with self.app:
+            await self.app.start()
+            
+            try:
+                # Listen before registering the webhook so Telegram's first push
+                # isn't refused
+                if runner:
+                    await runner.setup()
+                    await web.TCPSite(runner, '0.0.0.0', port).start()
+                    print(f"HTTP server running on port {port}")
+                
+                if webhook_host:
+                    # Telegram pushes updates instead of us long-polling getUpdates
+                    await self.app.bot.set_webhook(
+                        url=f"https://{webhook_host}/{self.token}",
+                        allowed_updates=Update.ALL_TYPES,
+                        secret_token=self._webhook_secret
+                    )
+                else:
+                    await self.app.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+                
+                # Serve until SIGINT/SIGTERM, then shut down cleanly so the updater
+                # acknowledges fetched updates and in-flight transfers finish
+                stop = asyncio.Event()
+                if sys.platform != 'win32':
+                    loop = asyncio.get_running_loop()
+                    for sig in (signal.SIGINT, signal.SIGTERM):
+                        loop.add_signal_handler(sig, stop.set)
+                
+                await stop.wait()
+            finally:
+                if runner:
+                    await runner.cleanup()
+                if self.app.updater.running:
+                    await self.app.updater.stop()
+                await self.app.stop()
+    
     def run(self):
         """Start the bot"""
         print("🎌 Anime Auto Rename Bot starting...")
         
-        # Start health check server in background if PORT is set (for web services)
-        port = os.getenv('PORT')
-        if port:
-            def start_health_server():
-                class HealthHandler(BaseHTTPRequestHandler):
-                    def do_GET(self):
-                        self.send_response(200)
-                        self.send_header('Content-type', 'text/plain')
-                        self.end_headers()
-                        self.wfile.write(b'Bot is running!')
-                    
-                    def log_message(self, format, *args):
-                        pass  # Suppress logs
-                
-                server = HTTPServer(('0.0.0.0', int(port)), HealthHandler)
-                server.serve_forever()
-            
-            Thread(target=start_health_server, daemon=True).start()
-            print(f"Health check server running on port {port}")
+        # Use a webhook when a public host is configured, otherwise poll.
+        # PORT (required for webhooks) also exposes the health check.
+        webhook_host = os.getenv('WEBHOOK_HOST')
+        port = os.getenv('PORT', '8080' if webhook_host else None)
         
-        self.app.run_polling(allowed_updates=Update.ALL_TYPES)
+        try:
+            asyncio.run(self.serve(int(port) if port else None, webhook_host))
+        except KeyboardInterrupt:
+            pass
 
 # Main execution
 if __name__ == "__main__":
-    # Replace with your bot token from @BotFather
-    BOT_TOKEN = "7921810145:AAH2expauUOLsDtA-2ukiafCXevWaiYaYgI"
+    # Bot token from @BotFather
+    BOT_TOKEN = os.getenv('BOT_TOKEN')
     
-    if BOT_TOKEN == "YOUR_BOT_TOKEN_HERE":
-        print("❌ Please replace BOT_TOKEN with your actual bot token from @BotFather")
+    if not BOT_TOKEN:
+        print("❌ Please set the BOT_TOKEN environment variable to your bot token from @BotFather")
         print("Visit https://t.me/BotFather to create a new bot and get your token")
         exit(1)
     